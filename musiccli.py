@@ -1,34 +1,137 @@
+import asyncio
 import os
+import queue
+import re
 import sys
 import threading
+from collections import deque
+from itertools import islice
 from pathlib import Path
-from queue import Queue
 from rich.console import Console
 from rich.panel import Panel
 from rich.table import Table
 from rich.live import Live
 from rich.prompt import Prompt
 from rich import box
+from diskcache import Cache
 import yt_dlp
 
-console = Console()
+# All colouring is explicit markup, so skip the per-print highlighter regexes.
+console = Console(highlight=False)
 
-download_queue = Queue()
-active_downloads = {}
-completed_downloads = []
-failed_downloads = []
-queue_lock = threading.Lock()
-stop_display = threading.Event()
+meta_cache = Cache('.musiccli_cache')
+# Negative entries are what save requests: a recently failed video ID fails
+# without contacting YouTube. Positive entries are cosmetic; every download
+# still does a full lookup, and the cached title only lets the table show
+# it before that lookup finishes (mostly useful across sessions, since
+# seen_ids already blocks re-queueing within one).
+META_TTL = 24 * 60 * 60
+NEGATIVE_TTL = 10 * 60
+CACHED_FIELDS = ('title',)
+YOUTUBE_URL_RE = re.compile(
+    r'^(?:https?://)?(?:(?:www|m|music)\.)?(?:'
+    r'(?:youtube\.com/(?:watch\?(?:.*&)?v=|shorts/|embed/)|youtu\.be/)'
+    r'(?P<id>[A-Za-z0-9_-]{11})(?![A-Za-z0-9_-])'
+    r'|youtube\.com/playlist\?(?:.*&)?list=[A-Za-z0-9_-]+)'
+)
+
+# One slot per worker, assigned only by that worker and read by the status
+# display, both on the event loop thread.
+active_slots = []
+# Only the last few entries are ever shown, so keep a small bounded history.
+HISTORY_SIZE = 64
+HISTORY_ROWS = 3
+completed_downloads = deque(maxlen=HISTORY_SIZE)
+failed_downloads = deque(maxlen=HISTORY_SIZE)
+# Per-item token -> title for tracks currently in the FFmpeg pool.
+converting = {}
+stats = {'completed': 0, 'failed': 0}
+# Video IDs that are queued, in flight or done (playlist URLs until they
+# are expanded). Failed ones are dropped again so they can be retried.
+seen_ids = set()
+# Set whenever something shown in the status table changes; the display
+# only re-renders when it is set.
+dirty = threading.Event()
+# (slot, progress, title) tuples pushed by progress hooks on worker
+# threads and applied by the status display.
+progress_events = queue.SimpleQueue()
+# Bytes read from stdin but not yet handed out as a command line.
+stdin_buffer = bytearray()
+stdin_state = {'selectable': True}
+# Without a known total size, report progress every this many bytes.
+PROGRESS_CHUNK = 256 * 1024
+FRAGMENT_WORKERS = 4
+
+# Options every worker's YoutubeDL is built from. The instances themselves
+# are not shared: each worker keeps its own for the whole session, and with
+# yt-dlp's requests handler installed (yt-dlp[default]) that instance's
+# keep-alive session reuses connections across the videos it downloads.
+BASE_YDL_OPTS = {
+    'format': 'bestaudio/best',
+    'quiet': True,
+    'no_warnings': True,
+    'socket_timeout': 20,
+    # Request media in 10 MiB byte ranges rather than one long response.
+    'http_chunk_size': 10 * 1024 * 1024,
+    # Fetch HLS/DASH fragments of a single track in parallel.
+    'concurrent_fragment_downloads': FRAGMENT_WORKERS,
+}
+
+def usable_cpus():
+    # sched_getaffinity respects CPU pinning (containers, taskset); it only
+    # exists on Linux.
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 2
 
 def create_music_folder():
     music_dir = Path("music")
     music_dir.mkdir(exist_ok=True)
     return music_dir
 
+def describe_error(e):
+    # Short message for the status table, taken from attributes yt-dlp
+    # already holds instead of rendering the full exception text.
+    # report_error() outside an except block gives exc_info (None, None,
+    # None); only unwrap when there really is an original exception.
+    if isinstance(e, yt_dlp.utils.DownloadError) and e.exc_info and e.exc_info[1] is not None:
+        e = e.exc_info[1]
+    if isinstance(e, yt_dlp.utils.ExtractorError):
+        return e.orig_msg[:50]
+    if isinstance(e, yt_dlp.utils.YoutubeDLError):
+        return e.msg[:50]
+    if isinstance(e, OSError) and e.strerror:
+        return e.strerror[:50]
+    return type(e).__name__
+
+def cached_info(vid):
+    if vid is None:
+        return None
+    cached = meta_cache.get(vid)
+    if cached is not None and 'error' in cached:
+        raise yt_dlp.utils.YoutubeDLError(cached['error'])
+    return cached
+
+def download_info(ydl, vid, url):
+    # A single extraction pass: extract_info(download=True) resolves the
+    # formats, downloads, and returns the info dict with the file path.
+    try:
+        info = ydl.extract_info(url, download=True)
+    except yt_dlp.utils.DownloadError as e:
+        # Remember failures for a short while so a re-queued URL fails fast
+        # instead of hitting YouTube again.
+        if vid is not None:
+            meta_cache.set(vid, {'error': describe_error(e)}, expire=NEGATIVE_TTL)
+        raise
+    
+    if vid is not None:
+        meta_cache.set(vid, {k: info.get(k) for k in CACHED_FIELDS}, expire=META_TTL)
+    return info
+
 def show_banner():
     banner = """
     ♪ YouTube Music Downloader ♪
-    Multi-threaded Queue System
+    Async Queue System
     """
     console.print(Panel(
         banner,
@@ -37,163 +140,427 @@ def show_banner():
         border_style="bright_magenta"
     ))
 
-def create_status_table():
+def recent(history):
+    # Oldest first, like the old list[-3:] slice, without copying the deque.
+    return reversed(list(islice(reversed(history), HISTORY_ROWS)))
+
+def create_status_table(download_queue):
     table = Table(box=box.ROUNDED, show_header=True, header_style="bold magenta")
     table.add_column("Status", style="cyan", width=12)
     table.add_column("Title", style="white", width=50)
     table.add_column("Progress", style="green", width=20)
     
-    with queue_lock:
-        for url, info in active_downloads.items():
-            title = info.get('title', 'Fetching info...')[:47] + "..."
-            progress = info.get('progress', '0%')
-            table.add_row("⬇️ Downloading", title, progress)
-        
-        queue_size = download_queue.qsize()
-        if queue_size > 0:
-            table.add_row("⏳ In Queue", f"{queue_size} video(s) waiting", "-")
-        
-        for item in completed_downloads[-3:]:
-            table.add_row("✓ Completed", item[:47] + "...", "100%")
-        
-        for item in failed_downloads[-3:]:
-            table.add_row("✗ Failed", item[:47] + "...", "Error")
+    for info in active_slots:
+        if info is None:
+            continue
+        title = info.get('title', 'Fetching info...')[:47] + "..."
+        progress = info.get('progress', '0%')
+        table.add_row("⬇️ Downloading", title, progress)
+    
+    for title in converting.values():
+        table.add_row("🎛 Converting", title[:47] + "...", "-")
+    
+    queue_size = download_queue.qsize()
+    if queue_size > 0:
+        table.add_row("⏳ In Queue", f"{queue_size} video(s) waiting", "-")
+    
+    for item in recent(completed_downloads):
+        table.add_row("✓ Completed", item[:47] + "...", "100%")
+    
+    for item in recent(failed_downloads):
+        table.add_row("✗ Failed", item[:47] + "...", "Error")
     
     return table
 
-def download_worker(music_dir, worker_id):
+def is_playlist_url(url):
+    return 'list=' in url
+
+def seen_key(vid, url):
+    # A watch?v=X&list=Y link stands for the whole playlist, so it's keyed
+    # by URL; keying it by X would make the expansion skip X itself.
+    return url if is_playlist_url(url) or vid is None else vid
+
+def playlist_entry_urls(ydl, url):
+    # process=False returns the flat playlist without resolving every
+    # entry; each video is looked up when a worker actually downloads it.
+    info = ydl.extract_info(url, download=False, process=False)
+    while info.get('_type') in ('url', 'url_transparent'):
+        info = ydl.extract_info(info['url'], download=False, process=False)
+    
+    return [
+        (entry['id'], f"https://www.youtube.com/watch?v={entry['id']}")
+        for entry in info.get('entries') or ()
+        if entry and entry.get('id')
+    ]
+
+def run_blocking(func, *args):
+    # Runs a blocking call on a daemon thread and returns an awaitable for
+    # its result. Unlike a ThreadPoolExecutor, whose threads are joined at
+    # interpreter exit, a daemon thread stuck in a long download can't keep
+    # the program alive after Ctrl+C or EOF.
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    
+    def deliver(result, error):
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+    
+    def runner():
+        result, error = None, None
+        try:
+            result = func(*args)
+        except Exception as e:
+            error = e
+        try:
+            loop.call_soon_threadsafe(deliver, result, error)
+        except RuntimeError:
+            # The event loop is already closed; nobody is waiting any more.
+            pass
+    
+    threading.Thread(target=runner, daemon=True).start()
+    return future
+
+async def download_worker(download_queue, postprocess_queue, music_dir, worker_id):
+    last = {'slot': None, 'mark': None}
+    
+    # Runs on a worker thread, so it only reports progress and leaves
+    # applying it to the status display. yt-dlp calls it for every chunk;
+    # only a change of whole percent (or PROGRESS_CHUNK bytes) is reported.
+    def progress_hook(d):
+        slot = active_slots[worker_id]
+        if slot is None:
+            return
+        if d['status'] == 'downloading':
+            downloaded = d.get('downloaded_bytes') or 0
+            total = d.get('total_bytes') or d.get('total_bytes_estimate')
+            mark = int(downloaded * 100 / total) if total else downloaded // PROGRESS_CHUNK
+            if last['slot'] is slot and last['mark'] == mark:
+                return
+            last['slot'], last['mark'] = slot, mark
+            progress_events.put_nowait((slot, d.get('_percent_str', '0%'), d['info_dict'].get('title')))
+        elif d['status'] == 'finished':
+            progress_events.put_nowait((slot, '100%', d['info_dict'].get('title')))
+    
+    # No yt-dlp postprocessors: the MP3 encode runs in ffmpeg_worker so
+    # this worker can start on the next URL right away.
+    ydl_opts = {
+        **BASE_YDL_OPTS,
+        # The ID keeps two videos with the same title from sharing a file.
+        'outtmpl': str(music_dir / '%(title)s [%(id)s].%(ext)s'),
+        'progress_hooks': [progress_hook],
+    }
+    
+    # One YoutubeDL per worker, built once and reused for every URL. Building
+    # it takes tens of milliseconds, so that happens off the event loop too
+    # rather than stalling it while workers start.
+    ydl = await run_blocking(yt_dlp.YoutubeDL, ydl_opts)
     while True:
-        url = download_queue.get()
-        if url is None:
+        item = await download_queue.get()
+        if item is None:
+            download_queue.task_done()
             break
         
+        vid, url = item
+        
         try:
-            with queue_lock:
-                active_downloads[url] = {'title': 'Fetching info...', 'progress': '0%'}
-            
-            ydl_opts = {
-                'format': 'bestaudio/best',
-                'postprocessors': [{
-                    'key': 'FFmpegExtractAudio',
-                    'preferredcodec': 'mp3',
-                    'preferredquality': '192',
-                }],
-                'outtmpl': str(music_dir / '%(title)s.%(ext)s'),
-                'quiet': True,
-                'no_warnings': True,
-            }
-            
-            def progress_hook(d):
-                if d['status'] == 'downloading':
-                    percent = d.get('_percent_str', '0%')
-                    with queue_lock:
-                        if url in active_downloads:
-                            active_downloads[url]['progress'] = percent
-                elif d['status'] == 'finished':
-                    with queue_lock:
-                        if url in active_downloads:
-                            active_downloads[url]['progress'] = '100%'
+            if is_playlist_url(url):
+                active_slots[worker_id] = {'title': 'Resolving playlist...', 'progress': '-'}
+                dirty.set()
+                entries = await run_blocking(playlist_entry_urls, ydl, url)
+                for entry in entries:
+                    if entry[0] not in seen_ids:
+                        seen_ids.add(entry[0])
+                        download_queue.put_nowait(entry)
+                # The entries are tracked individually, so the same
+                # playlist can be pasted again later to pick up new videos.
+                seen_ids.discard(url)
+                dirty.set()
+                continue
             
-            ydl_opts['progress_hooks'] = [progress_hook]
+            slot = {'title': 'Fetching info...', 'progress': '0%'}
+            active_slots[worker_id] = slot
+            dirty.set()
             
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(url, download=False)
-                title = info.get('title', 'Unknown')
-                
-                with queue_lock:
-                    if url in active_downloads:
-                        active_downloads[url]['title'] = title
-                
-                ydl.download([url])
+            # A cached title can be shown straight away; otherwise the
+            # progress hook reports it once the download starts.
+            cached = await run_blocking(cached_info, vid)
+            if cached is not None and cached.get('title'):
+                slot['title'] = cached['title']
+                dirty.set()
             
-            with queue_lock:
-                if url in active_downloads:
-                    del active_downloads[url]
-                completed_downloads.append(title)
+            info = await run_blocking(download_info, ydl, vid, url)
+            title = info.get('title', 'Unknown')
             
+            filepath = info['requested_downloads'][0]['filepath']
+            postprocess_queue.put_nowait((vid, Path(filepath), title, info.get('acodec')))
+        
         except Exception as e:
-            error_msg = str(e)[:50]
-            with queue_lock:
-                if url in active_downloads:
-                    title = active_downloads[url].get('title', url[:50])
-                    del active_downloads[url]
-                    failed_downloads.append(f"{title} - {error_msg}")
+            seen_ids.discard(seen_key(vid, url))
+            slot = active_slots[worker_id]
+            title = slot['title'] if slot else url[:50]
+            failed_downloads.append(f"{title} - {describe_error(e)}")
+            stats['failed'] += 1
         
         finally:
+            active_slots[worker_id] = None
+            dirty.set()
             download_queue.task_done()
+    
+    # Only reached after the quit sentinel, when no call is using ydl. On
+    # Ctrl+C or EOF the task is cancelled instead, and ydl is left to the
+    # exiting process rather than closed under a running download.
+    ydl.close()
+
+def ffmpeg_command(src, acodec):
+    # AAC is already a fine delivery format, so it's remuxed into .m4a
+    # instead of being decoded and re-encoded; anything else (usually
+    # Opus in WebM) becomes a 192 kbps MP3. None means no FFmpeg run.
+    if (acodec or '').startswith(('mp4a', 'aac')):
+        if src.suffix == '.m4a':
+            return None
+        dst, codec_args = src.with_suffix('.m4a'), ['-c:a', 'copy']
+    elif src.suffix == '.mp3':
+        return None
+    else:
+        dst, codec_args = src.with_suffix('.mp3'), ['-b:a', '192k']
+    
+    return ['ffmpeg', '-y', '-loglevel', 'error', '-i', str(src), '-vn', *codec_args, str(dst)]
 
-def status_display():
-    with Live(create_status_table(), refresh_per_second=2, console=console, screen=False) as live:
+async def ffmpeg_worker(postprocess_queue):
+    while True:
+        item = await postprocess_queue.get()
+        if item is None:
+            postprocess_queue.task_done()
+            break
+        
+        vid, src, title, acodec = item
+        token = object()
+        converting[token] = title
+        dirty.set()
+        
+        try:
+            cmd = ffmpeg_command(src, acodec)
+            if cmd is not None:
+                proc = await asyncio.create_subprocess_exec(
+                    *cmd,
+                    stdout=asyncio.subprocess.DEVNULL,
+                    stderr=asyncio.subprocess.PIPE,
+                )
+                _, stderr = await proc.communicate()
+                if proc.returncode != 0:
+                    lines = stderr.decode(errors='replace').strip().splitlines()
+                    raise yt_dlp.utils.PostProcessingError(lines[-1] if lines else f"ffmpeg exited with {proc.returncode}")
+                src.unlink()
+            
+            completed_downloads.append(title)
+            stats['completed'] += 1
+        
+        except Exception as e:
+            seen_ids.discard(vid)
+            failed_downloads.append(f"{title} - {describe_error(e)}")
+            stats['failed'] += 1
+        
+        finally:
+            converting.pop(token, None)
+            dirty.set()
+            postprocess_queue.task_done()
+
+def apply_progress_events():
+    while True:
+        try:
+            slot, progress, title = progress_events.get_nowait()
+        except queue.Empty:
+            return
+        # Events for a slot the worker has already replaced land on the
+        # old dict and are simply never shown.
+        if slot.get('progress') != progress:
+            slot['progress'] = progress
+            dirty.set()
+        if title and slot.get('title') != title:
+            slot['title'] = title
+            dirty.set()
+
+async def status_display(download_queue, stop_display):
+    # auto_refresh is off so nothing is redrawn while the table is unchanged.
+    with Live(create_status_table(download_queue), auto_refresh=False, console=console, screen=False) as live:
         while not stop_display.is_set():
-            live.update(create_status_table())
-            stop_display.wait(0.5)
+            apply_progress_events()
+            if dirty.is_set():
+                dirty.clear()
+                live.update(create_status_table(download_queue), refresh=True)
+            try:
+                await asyncio.wait_for(stop_display.wait(), timeout=0.5)
+            except asyncio.TimeoutError:
+                pass
+        # Leave the final state on screen when the display stops.
+        live.update(create_status_table(download_queue))
+
+def take_line():
+    end = stdin_buffer.find(b'\n')
+    if end < 0:
+        return None
+    line = bytes(stdin_buffer[:end])
+    del stdin_buffer[:end + 1]
+    return line.decode(sys.stdin.encoding or 'utf-8', errors='replace').rstrip('\r')
 
-def main():
+async def read_command_threaded(prompt):
+    # Fallback for event loops without add_reader (Windows) or stdin that
+    # can't be polled (a redirected regular file).
+    def read():
+        try:
+            return console.input(prompt)
+        except EOFError:
+            return None
+    
+    return await run_blocking(read)
+
+async def read_command(prompt):
+    # Reads stdin through the event loop's selector, so the prompt never
+    # has a thread blocked in input() and Ctrl+C or shutdown isn't held up
+    # waiting for Enter. Bytes are buffered here rather than by sys.stdin,
+    # whose own buffer the selector can't see.
+    if not stdin_state['selectable']:
+        return await read_command_threaded(prompt)
+    
+    console.print(prompt, end="")
+    line = take_line()
+    if line is not None:
+        return line
+    
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    fd = sys.stdin.fileno()
+    
+    def on_readable():
+        chunk = os.read(fd, 4096)
+        if not chunk:
+            # EOF: hand out a final unterminated line, then None.
+            rest = None
+            if stdin_buffer:
+                rest = bytes(stdin_buffer).decode(sys.stdin.encoding or 'utf-8', errors='replace')
+                stdin_buffer.clear()
+            if not future.done():
+                future.set_result(rest)
+            return
+        stdin_buffer.extend(chunk)
+        line = take_line()
+        if line is not None and not future.done():
+            future.set_result(line)
+    
+    try:
+        loop.add_reader(fd, on_readable)
+    except (NotImplementedError, PermissionError):
+        stdin_state['selectable'] = False
+        return await read_command_threaded("")
+    
+    try:
+        return await future
+    finally:
+        loop.remove_reader(fd)
+
+async def main():
     console.clear()
     show_banner()
     
     music_dir = create_music_folder()
     console.print(f"[dim]Music will be saved to: {music_dir.absolute()}[/dim]")
-    console.print(f"[dim]Using 3 concurrent download threads[/dim]\n")
     
-    num_workers = 3
-    workers = []
-    for i in range(num_workers):
-        t = threading.Thread(target=download_worker, args=(music_dir, i), daemon=True)
-        t.start()
-        workers.append(t)
+    # Downloads are network-bound, so the pool is capped to stay clear of
+    # YouTube's per-IP throttling; encodes are CPU-bound and get half the
+    # usable cores.
+    cpus = usable_cpus()
+    num_workers = min(8, max(2, cpus))
+    num_encoders = max(1, cpus // 2)
+    console.print(f"[dim]Using {num_workers} concurrent downloads and {num_encoders} encoder(s)[/dim]\n")
+    
+    download_queue = asyncio.Queue()
+    postprocess_queue = asyncio.Queue()
+    stop_display = asyncio.Event()
+    active_slots[:] = [None] * num_workers
+    workers = [
+        asyncio.create_task(download_worker(download_queue, postprocess_queue, music_dir, worker_id))
+        for worker_id in range(num_workers)
+    ]
+    encoders = [
+        asyncio.create_task(ffmpeg_worker(postprocess_queue))
+        for _ in range(num_encoders)
+    ]
     
-    status_thread = threading.Thread(target=status_display, daemon=True)
-    status_thread.start()
+    status_task = asyncio.create_task(status_display(download_queue, stop_display))
     
     console.print("[yellow]Commands:[/yellow]")
     console.print("[yellow]  - Paste YouTube URL to add to queue[/yellow]")
     console.print("[yellow]  - 'q' to quit[/yellow]")
-    console.print("[yellow]  - 's' to show status[/yellow]\n")
+    console.print("[yellow]  - 's' to show status[/yellow]")
+    console.print("[yellow]  - 'clear-cache' to forget cached video info[/yellow]\n")
     
     try:
         while True:
-            try:
-                url = console.input("[bold cyan]Enter URL (or command): [/bold cyan]")
-            except EOFError:
+            url = await read_command("[bold cyan]Enter URL (or command): [/bold cyan]")
+            if url is None:
                 break
+            url = url.strip()
             
             if url.lower() == 'q':
                 console.print("\n[bold yellow]Waiting for downloads to complete...[/bold yellow]")
-                download_queue.join()
+                await download_queue.join()
+                await postprocess_queue.join()
                 stop_display.set()
                 
                 for _ in workers:
-                    download_queue.put(None)
-                for t in workers:
-                    t.join()
+                    download_queue.put_nowait(None)
+                for _ in encoders:
+                    postprocess_queue.put_nowait(None)
+                await asyncio.gather(*workers, *encoders)
+                await status_task
+                meta_cache.close()
                 
                 console.print("\n[bold magenta]👋 Goodbye![/bold magenta]\n")
-                console.print(f"[green]✓ Completed: {len(completed_downloads)}[/green]")
-                console.print(f"[red]✗ Failed: {len(failed_downloads)}[/red]\n")
+                console.print(f"[green]✓ Completed: {stats['completed']}[/green]")
+                console.print(f"[red]✗ Failed: {stats['failed']}[/red]\n")
                 break
             
             if url.lower() == 's':
                 continue
             
-            if not url.strip():
+            if url.lower() == 'clear-cache':
+                cleared = meta_cache.clear()
+                console.print(f"[green]✓[/green] Cleared {cleared} cached entr{'y' if cleared == 1 else 'ies'}\n")
+                continue
+            
+            if not url:
                 console.print("[red]Please enter a valid URL[/red]\n")
                 continue
             
-            if 'youtube.com' not in url and 'youtu.be' not in url:
+            match = YOUTUBE_URL_RE.match(url)
+            if not match:
                 console.print("[red]Please enter a valid YouTube URL[/red]\n")
                 continue
             
-            download_queue.put(url)
+            vid = match.group('id')
+            key = seen_key(vid, url)
+            if key in seen_ids:
+                console.print("[yellow]Already queued or downloaded[/yellow]\n")
+                continue
+            seen_ids.add(key)
+            
+            download_queue.put_nowait((vid, url))
+            dirty.set()
             console.print(f"[green]✓[/green] Added to queue (Queue size: {download_queue.qsize()})\n")
     
-    except KeyboardInterrupt:
+    finally:
+        # On Ctrl+C or EOF, downloads may still be using meta_cache on their
+        # threads, so it's only closed on the 'q' path above; diskcache's
+        # SQLite store is safe to abandon at exit.
         stop_display.set()
-        console.print("\n\n[bold magenta]👋 Goodbye![/bold magenta]\n")
 
 if __name__ == "__main__":
     try:
-        main()
+        asyncio.run(main())
     except KeyboardInterrupt:
         console.print("\n\n[bold magenta]👋 Goodbye![/bold magenta]\n")
         sys.exit(0)
\ No newline at end of file
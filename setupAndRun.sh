@@ -1,4 +1,4 @@
 python3 -m venv venv
 source venv/bin/activate
-pip3 install yt-dlp rich
+pip3 install "yt-dlp[default]" rich diskcache
 python3 musiccli.py